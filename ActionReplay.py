@@ -22,90 +22,135 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
-from io import SEEK_SET, TextIOWrapper
-from typing import Any
-from datetime import datetime
+from io import SEEK_SET, BufferedReader
+from collections import deque
+from typing import Any, Callable
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
 import pygame
-import copy
+import logging
 import sys
 
+logger: logging.Logger = logging.getLogger(__name__)
+
+
 class Model_EventParser:
     TAG: str = 'EventParser'
 
     __activeSlot: int = 0
-    __slots: dict[int, dict[str, int | None]] = {}
     __slotsReady: int | None = None  # Becomes timestamp of last SYN_REPORT on getting one, is reset after read
 
+    def __init__(self, initialSlotCount: int = 16) -> None:
+        # Slots are stored as parallel arrays indexed by slot ID, -1 stands for None
+        self.__slotsTrackingID: array = array('q', [-1] * initialSlotCount)
+        self.__slotsX: array = array('q', [-1] * initialSlotCount)
+        self.__slotsY: array = array('q', [-1] * initialSlotCount)
+        self.__warnedEvents: set[tuple[int, int]] = set()  # (type, code)
+
     def parse_event_line(self, _eventLine: str) -> None:
-        eventLine: list[str] = _eventLine.strip().split()
+        eventLine: list[str] = _eventLine.split()
         assert(len(eventLine) == 5)
 
-        timestampStr: str = '{} {}'.format(eventLine[0], eventLine[1])
-        timestampMs: int = int(datetime.strptime(timestampStr, '%Y/%m/%d %H:%M:%S.%f').timestamp() * 1000)  # Epoch with timezone offset
-
-        event: dict[str, int] = {'timestamp': timestampMs,
-                                 'type': int(eventLine[2], base=16),
-                                 'code': int(eventLine[3], base=16),
-                                 'value': int(eventLine[4], base=16)}
-        
-        if event['type'] == 0x0003:  # EV_ABS
-            match event['code']:
-                # ABS_MT_SLOT
-                case 0x002f:
-                    self.__select_slot(event['value'])
-                # ABS_MT_TRACKING_ID
-                case 0x0039:
-                    if event['value'] != self.__safe_get_slot(self.__activeSlot)['tracking_id']:
-                        self.__init_slot(self.__activeSlot)
-                        if event['value'] != 0xffffffff:
-                            self.__safe_get_slot(self.__activeSlot)['tracking_id'] = event['value']
-                # ABS_MT_POSITION_X
-                case 0x0035:
-                    self.__safe_get_slot(self.__activeSlot)['x'] = event['value']
-                # ABS_MT_POSITION_Y
-                case 0x0036:
-                    self.__safe_get_slot(self.__activeSlot)['y'] = event['value']
-                case _:
-                    print('{}: Warning: Unhandled event: type EV_ABS, code {}, value {}'.format(self.TAG, event['code'], event['value']))
-        elif event['type'] == 0x0000:  # SYN_REPORT
-            self.__ready_slots(event['timestamp'])
+        eventType: int = int(eventLine[2], base=16)
+        eventCode: int = int(eventLine[3], base=16)
+        eventValue: int = int(eventLine[4], base=16)
+
+        if eventType == 0x0003:  # EV_ABS
+            absEventHandler = self.__absEventHandlers.get(eventCode)
+            if absEventHandler is not None:
+                absEventHandler(self, eventValue)
+            else:
+                self.__warn_unhandled_event(eventType, eventCode, eventValue)
+        elif eventType == 0x0000:  # SYN_REPORT
+            self.__ready_slots(self.__parse_timestamp(eventLine[1]))  # Only SYN_REPORT timestamps are ever used
         else:
-            if event['type'] != 0x0001 and event['code'] != 0x014a:  # Don't care about BTN_TOUCH
-                print('{}: Warning: Unhandled event: type {}, code {}, value {}'.format(self.TAG, event['type'], event['code'], event['value']))
+            if eventType != 0x0001 and eventCode != 0x014a:  # Don't care about BTN_TOUCH
+                self.__warn_unhandled_event(eventType, eventCode, eventValue)
 
-    def __init_slot(self, slotID: int) -> None:
-        self.__slots[slotID] = {'tracking_id': None,
-                               'x': None,
-                               'y': None}
+    # Noisy logs can have thousands of these, only warn once for each (type, code)
+    def __warn_unhandled_event(self, eventType: int, eventCode: int, eventValue: int) -> None:
+        if (eventType, eventCode) in self.__warnedEvents:
+            return
+        self.__warnedEvents.add((eventType, eventCode))
+        logger.warning('{}: Unhandled event: type {}, code {}, value {} (further ones of the same type and code are not reported)'.format(self.TAG, 'EV_ABS' if eventType == 0x0003 else eventType, eventCode, eventValue))
+
+    # ABS_MT_TRACKING_ID
+    def __handle_abs_mt_tracking_id(self, value: int) -> None:
+        self.__ensure_slot(self.__activeSlot)
+        if value != self.__slotsTrackingID[self.__activeSlot]:
+            self.__init_slot(self.__activeSlot)
+            if value != 0xffffffff:
+                self.__slotsTrackingID[self.__activeSlot] = value
+
+    # ABS_MT_POSITION_X
+    def __handle_abs_mt_position_x(self, value: int) -> None:
+        self.__ensure_slot(self.__activeSlot)
+        self.__slotsX[self.__activeSlot] = value
+
+    # ABS_MT_POSITION_Y
+    def __handle_abs_mt_position_y(self, value: int) -> None:
+        self.__ensure_slot(self.__activeSlot)
+        self.__slotsY[self.__activeSlot] = value
+
+    # Fixed-width 'HH:MM:SS.ffffff', strptime is way too slow for every single line.
+    # Returns milliseconds since midnight, only deltas between timestamps are used anyway (see Controller.__timestamp_delta)
+    def __parse_timestamp(self, timeStr: str) -> int:
+        return int(timeStr[0:2]) * 3600000 \
+               + int(timeStr[3:5]) * 60000 \
+               + int(timeStr[6:8]) * 1000 \
+               + int(timeStr[9:15]) // 1000
 
-    def __safe_get_slot(self, slotID: int) -> dict[str, int | None]:
-        # Create slots if not exist
-        if slotID not in self.__slots.keys():
-            self.__init_slot(slotID)
-        return self.__slots[slotID]  # Pass by reference
+    def __init_slot(self, slotID: int) -> None:
+        self.__slotsTrackingID[slotID] = -1
+        self.__slotsX[slotID] = -1
+        self.__slotsY[slotID] = -1
+
+    def __ensure_slot(self, slotID: int) -> None:
+        # Grow slots if not exist
+        if slotID >= len(self.__slotsTrackingID):
+            growth: array = array('q', [-1] * (slotID + 1 - len(self.__slotsTrackingID)))
+            self.__slotsTrackingID.extend(growth)
+            self.__slotsX.extend(growth)
+            self.__slotsY.extend(growth)
 
     def __select_slot(self, slotID: int) -> None:
         self.__activeSlot = slotID
 
     def __ready_slots(self, timestamp: int) -> None:
         if self.__slotsReady is not None:
-            print('{}: Warning: Unread SYN_REPORT, timestamp {}'.format(self.TAG, self.__slotsReady))
+            logger.warning('{}: Unread SYN_REPORT, timestamp {}'.format(self.TAG, self.__slotsReady))
         self.__slotsReady = timestamp
 
-    def get_slots(self) -> dict[int, dict[str, int | None]]:
-        return self.__slots
+    # (tracking IDs, Xs, Ys), passed by reference
+    def get_slots(self) -> tuple[array, array, array]:
+        return self.__slotsTrackingID, self.__slotsX, self.__slotsY
     
     def get_slots_ready(self) -> int | None:
         slotsReady: int | None = self.__slotsReady
         self.__slotsReady = None
         return slotsReady
 
+    __absEventHandlers: dict[int, Callable[['Model_EventParser', int], None]] = {
+        0x002f: __select_slot,  # ABS_MT_SLOT
+        0x0039: __handle_abs_mt_tracking_id,
+        0x0035: __handle_abs_mt_position_x,
+        0x0036: __handle_abs_mt_position_y
+    }
+
+
+class _Trail:
+    __slots__ = ('start', 'end')  # Way smaller than a dict, and attribute access is cheaper
+
+    def __init__(self, start: tuple[int, int] | None, end: tuple[int, int]) -> None:
+        self.start: tuple[int, int] | None = start
+        self.end: tuple[int, int] = end
+
 
 class View_UI:
     TAG: str = 'UI'
 
-    __trails: list[dict[str, Any]] = []
-    __persistent_trails: dict[int, dict[str, Any]] = {}
+    __persistent_trails: dict[int, _Trail] = {}
 
     __trailBg: tuple[int, int, int] = (0, 0, 0)
     __trailColor: tuple[int, int, int] = (255, 0, 0)
@@ -117,8 +162,7 @@ class View_UI:
     __toolbarBg: tuple[int, int, int] = (0, 0, 255)
     __toolbarFg: tuple[int, int, int] = (63, 63, 255)  # TODO: For mouse hovered buttons, not willing to implement this
     __toolbarTextColor: tuple[int, int, int] = (255, 255, 255)
-    __progressBarBoundingBoxes: list[dict[str, Any]] = []
-    __toolbarBtnBoundingBoxes: list[dict[str, Any]] = []
+    __textSurfaceCacheSize: int = 256
 
     def __init__(self, windowWidth: int, windowHeight: int, windowCaption: str, mainProgressBarHeight: int, subProgressBarHeight: int, toolbarHeight: int, trailFadeTimeMs: int) -> None:
         self.__windowSize: tuple[int, int] = windowWidth, windowHeight
@@ -127,12 +171,29 @@ class View_UI:
         self.__toolbarHeight: int = toolbarHeight
         self.__trailSurfaceSize: tuple[int, int] = windowWidth, windowHeight - mainProgressBarHeight - subProgressBarHeight - toolbarHeight
         self.__trailFadeTimeMs: int = trailFadeTimeMs
+        # Fading trails as parallel lists, in chronological order
+        self.__trailStarts: list[tuple[int, int] | None] = []
+        self.__trailEnds: list[tuple[int, int]] = []
+        self.__trailTimestamps: list[int] = []
 
         pygame.init()
         self.__windowSurface: pygame.Surface = pygame.display.set_mode(self.__windowSize)
         pygame.display.set_caption(windowCaption)
         self.__trailSurface = pygame.Surface(self.__trailSurfaceSize, flags=pygame.SRCALPHA)
+        self.__trailDirtyRects: list[pygame.Rect] = []  # Areas drawn on the trail surface last frame
+        # Trail surface holds premultiplied colors for the faster BLEND_PREMULTIPLIED blit, one palette entry per alpha bucket
+        self.__trailBucketColors: list[tuple[int, int, int, int]] = []
+        for bucket in range(32):
+            alpha: int = (bucket << 3) | 7
+            self.__trailBucketColors.append((*(channel * alpha // 255 for channel in self.__trailColor), alpha))
+        self.__displayDirtyRects: list[pygame.Rect] = []  # Areas of the window changed since last display update
+        self.__windowDirty: bool = True  # Whole window needs a display update
+        self.__toolbarDirty: bool = True
         self.__font: pygame.font.Font = pygame.font.SysFont('Consolas', 15)  # TODO
+        self.__textSurfaceCache: dict[tuple[str, tuple[int, int, int]], pygame.Surface] = {}  # LRU, oldest first
+        self.__progressBarBoundingBoxes: list[dict[str, Any]] = []
+        self.__toolbarBtnStartsX: list[int] = []
+        self.__toolbarBtnEndsX: list[int] = []
         self.__toolbarButtons: list[dict[str, Any]] = [{
                 'label': 'Pause',
                 'width': 60,
@@ -164,6 +225,7 @@ class View_UI:
         paused: bool = btn['custom_data']
         btn['custom_data'] = not paused
         btn['label'] = 'Play' if btn['custom_data'] else 'Pause'
+        self.__toolbarDirty = True
         return ('paused', btn['custom_data'])
 
     def __button_skip_callback(self, btn: dict[str, Any]) -> tuple[str, Any] | None:
@@ -176,6 +238,7 @@ class View_UI:
         speed: int = btn['custom_data']
         btn['custom_data'] = speed + 1 if speed < 10 else 1
         btn['label'] = '{}x'.format(btn['custom_data'])
+        self.__toolbarDirty = True
         return ('set_playback_speed_multiplier', btn['custom_data'])
 
     def __main_progress_bar_callback(self, relativeCoords: tuple[int, int]) -> tuple[str, Any] | None:
@@ -186,111 +249,200 @@ class View_UI:
         return None
 
     def add_trail(self, start: tuple[int, int] | None, end: tuple[int, int], timestampMs: int) -> None:
-        self.__trails.append({
-            'start': start,
-            'end': end,
-            'timestamp': timestampMs,
-            'expired': False
-        })
+        self.__trailStarts.append(start)
+        self.__trailEnds.append(end)
+        self.__trailTimestamps.append(timestampMs)
 
     def add_persistent_trail(self, start: tuple[int, int] | None, end: tuple[int, int], id: int) -> None:
-        self.__persistent_trails[id] = {
-            'start': start,
-            'end': end
-        }
+        self.__persistent_trails[id] = _Trail(start, end)
 
     def fade_persistent_trail(self, id: int | None = None, timestampMs: int | None = None) -> None:
         if id is not None:
-            if id not in self.__persistent_trails.keys():
+            if id not in self.__persistent_trails:
                 return
             if timestampMs is not None:
-                self.add_trail(self.__persistent_trails[id]['start'], self.__persistent_trails[id]['end'], timestampMs)
+                self.add_trail(self.__persistent_trails[id].start, self.__persistent_trails[id].end, timestampMs)
             del self.__persistent_trails[id]
         else:
             if timestampMs is not None:
-                for _, trail in self.__persistent_trails.items():
-                    self.add_trail(trail['start'], trail['end'], timestampMs)
+                for trail in self.__persistent_trails.values():
+                    self.add_trail(trail.start, trail.end, timestampMs)
             self.__persistent_trails.clear()
 
-    def __draw_trail_line_or_circle(self, color: Any, start: tuple[int, int] | None, end: tuple[int, int]) -> None:
+    def __draw_trail_line_or_circle(self, color: Any, start: tuple[int, int] | None, end: tuple[int, int]) -> pygame.Rect:
         if start is not None:
-            pygame.draw.line(self.__trailSurface, color, start, end, self.__trailLineWidth)
+            return pygame.draw.line(self.__trailSurface, color, start, end, self.__trailLineWidth)
         else:
-            pygame.draw.circle(self.__trailSurface, color, end, self.__trailPointRadius)
+            return pygame.draw.circle(self.__trailSurface, color, end, self.__trailPointRadius)
 
     def update_trails(self, timestampMs: int) -> None:
-        self.__trailSurface.fill((0, 0, 0, 0))
-        for trail in self.__trails:
-            alpha: int = min(round(255 * (1 - (timestampMs - trail['timestamp']) / self.__trailFadeTimeMs)), 255)
-            color: tuple[int, int, int, int] = (*self.__trailColor, alpha)
-            if alpha <= 0:
-                # Remove expired trails LATER
-                trail['expired'] = True
+        # Only clear what was drawn last frame instead of the whole surface
+        for dirtyRect in self.__trailDirtyRects:
+            self.__trailSurface.fill((0, 0, 0, 0), dirtyRect)
+        self.__displayDirtyRects.extend(self.__trailDirtyRects)  # Trail surface is blitted at (0, 0)
+        dirtyRects: list[pygame.Rect] = []
+
+        trailFadeTimeMs: int = self.__trailFadeTimeMs
+        # Trails are added in chronological order, so expired ones are always at the front
+        expiredCount: int = bisect_right(self.__trailTimestamps, timestampMs - trailFadeTimeMs)
+        if expiredCount > 0:
+            del self.__trailStarts[:expiredCount]
+            del self.__trailEnds[:expiredCount]
+            del self.__trailTimestamps[:expiredCount]
+
+        # Quantize alpha into 32 buckets and chain connected segments of the same bucket into polylines,
+        # so that draw calls scale with the number of strokes rather than the number of trails
+        polylineBuckets: dict[int, list[list[tuple[int, int]]]] = {}
+        polylineEnds: dict[int, dict[tuple[int, int], list[tuple[int, int]]]] = {}
+        pointBuckets: dict[int, list[tuple[int, int]]] = {}
+        for start, end, trailTimestampMs in zip(self.__trailStarts, self.__trailEnds, self.__trailTimestamps):
+            alpha: int = min(round(255 * (1 - (timestampMs - trailTimestampMs) / trailFadeTimeMs)), 255)
+            if alpha <= 0:  # Rounded down to invisible, will be removed in a later frame
                 continue
-            self.__draw_trail_line_or_circle(color, trail['start'], trail['end'])
-        self.__trails = [trail for trail in self.__trails if not trail['expired']]
-
-        for _, trail in self.__persistent_trails.items():
-            self.__draw_trail_line_or_circle(self.__trailColor, trail['start'], trail['end'])
-
-        self.__windowSurface.blit(self.__trailSurface, (0, 0))
+            bucket: int = alpha >> 3
+            if start is None:
+                pointBuckets.setdefault(bucket, []).append(end)
+                continue
+            ends: dict[tuple[int, int], list[tuple[int, int]]] = polylineEnds.setdefault(bucket, {})
+            polyline: list[tuple[int, int]] | None = ends.pop(start, None)
+            if polyline is None:
+                polyline = [start]
+                polylineBuckets.setdefault(bucket, []).append(polyline)
+            polyline.append(end)
+            ends[end] = polyline
+
+        self.__trailSurface.lock()
+        for bucket in sorted(polylineBuckets.keys() | pointBuckets.keys()):  # Newer trails on top
+            color: tuple[int, int, int, int] = self.__trailBucketColors[bucket]
+            for polyline in polylineBuckets.get(bucket, ()):
+                dirtyRects.append(pygame.draw.lines(self.__trailSurface, color, False, polyline, self.__trailLineWidth))
+            for point in pointBuckets.get(bucket, ()):
+                dirtyRects.append(pygame.draw.circle(self.__trailSurface, color, point, self.__trailPointRadius))
+
+        for trail in self.__persistent_trails.values():
+            dirtyRects.append(self.__draw_trail_line_or_circle(self.__trailColor, trail.start, trail.end))
+        self.__trailSurface.unlock()
+        self.__trailDirtyRects = self.__merge_rects(dirtyRects, self.__trailSurface.get_rect())
+        self.__displayDirtyRects.extend(self.__trailDirtyRects)
+
+        self.__windowSurface.blit(self.__trailSurface, (0, 0), special_flags=pygame.BLEND_PREMULTIPLIED)
+
+    # Merges overlapping rects, a single boundingRect if the merged ones would cover about as much anyway
+    def __merge_rects(self, rects: list[pygame.Rect], boundingRect: pygame.Rect) -> list[pygame.Rect]:
+        mergedRects: list[pygame.Rect] = []
+        mergedArea: int = 0
+        for rect in rects:
+            rect = rect.clip(boundingRect)
+            collidingIndex: int = rect.collidelist(mergedRects)
+            while collidingIndex != -1:
+                rect.union_ip(mergedRects.pop(collidingIndex))
+                collidingIndex = rect.collidelist(mergedRects)
+            mergedRects.append(rect)
+        for rect in mergedRects:
+            mergedArea += rect.width * rect.height
+        if mergedArea >= boundingRect.width * boundingRect.height:
+            return [boundingRect]
+        return mergedRects
 
     def draw_UI(self, mainProgressBarPercentage: float, mainProgressBarText: str, subProgressBarPercentage: float, subProgressBarText: str | None = None) -> None:
         progressBarWidth: int = self.__windowSize[0]
         drawUICoordY: int = self.__trailSurfaceSize[1]
-        
-        self.__draw_progress_bar(self.__windowSurface, (0, drawUICoordY), (progressBarWidth, self.__mainProgressBarHeight), mainProgressBarPercentage, mainProgressBarText)
+        blitSequence: list[tuple[pygame.Surface, tuple[int, int]] | tuple[pygame.Surface, tuple[int, int], pygame.Rect]] = []
+
+        self.__draw_progress_bar(blitSequence, (0, drawUICoordY), (progressBarWidth, self.__mainProgressBarHeight), mainProgressBarPercentage, mainProgressBarText)
         drawUICoordY += self.__mainProgressBarHeight
 
-        self.__draw_progress_bar(self.__windowSurface, (0, drawUICoordY), (progressBarWidth, self.__subProgressBarHeight), subProgressBarPercentage, subProgressBarText)
+        self.__draw_progress_bar(blitSequence, (0, drawUICoordY), (progressBarWidth, self.__subProgressBarHeight), subProgressBarPercentage, subProgressBarText)
         drawUICoordY += self.__subProgressBarHeight
 
-        self.__draw_toolbar(self.__windowSurface, (0, drawUICoordY), self.__toolbarHeight)
+        self.__draw_toolbar(blitSequence, (0, drawUICoordY))
+
+        self.__windowSurface.blits(blitSequence, doreturn=False)
+
+        self.__displayDirtyRects.append(self.__progressBarsRect)  # Text and percentages change almost every frame
+        if self.__toolbarDirty:
+            self.__displayDirtyRects.append(self.__toolbarRect)
+            self.__toolbarDirty = False
 
-    def __draw_progress_bar(self, surface: pygame.Surface, coords: tuple[int, int], size: tuple[int, int], percentage: float, text: str | None) -> None:
+    # Appends to blitSequence instead of drawing right away, parts are cropped from the pre-rendered surfaces
+    def __draw_progress_bar(self, blitSequence: list, coords: tuple[int, int], size: tuple[int, int], percentage: float, text: str | None) -> None:
         progressBarFilledWidth: int = round(size[0] * percentage)
-        pygame.draw.rect(surface, self.__progressBarFg, pygame.Rect(*coords, progressBarFilledWidth, size[1]))
-        pygame.draw.rect(surface, self.__progressBarBg, pygame.Rect(coords[0] + progressBarFilledWidth, coords[1], size[0] - progressBarFilledWidth, size[1]))
+        blitSequence.append((self.__progressBarFgSurface, coords, pygame.Rect(0, 0, progressBarFilledWidth, size[1])))
+        blitSequence.append((self.__progressBarBgSurface, (coords[0] + progressBarFilledWidth, coords[1]), pygame.Rect(0, 0, size[0] - progressBarFilledWidth, size[1])))
         if text is not None and len(text) > 0:
-            surface.blit(self.__font.render(text, True, self.__progressBarTextColor), (10, coords[1] + 10))  # TODO
+            blitSequence.append((self.__render_text(text, self.__progressBarTextColor), (10, coords[1] + 10)))  # TODO
 
-    def __draw_toolbar(self, surface: pygame.Surface, coords: tuple[int, int], height: int) -> None:
+    def __draw_toolbar(self, blitSequence: list, coords: tuple[int, int]) -> None:
         coordX, coordY = coords
+        blitSequence.append((self.__toolbarBgSurface, coords))
         for btn in self.__toolbarButtons:
-            pygame.draw.rect(surface, self.__toolbarBg, pygame.Rect(coordX, coordY, btn['width'], height))
-            surface.blit(self.__font.render(btn['label'], True, self.__toolbarTextColor), (coordX + 10, coordY + 10))  # TODO
+            blitSequence.append((self.__render_text(btn['label'], self.__toolbarTextColor), (coordX + 10, coordY + 10)))  # TODO
             coordX += btn['width'] + btn['rightMargin']
 
+    # Static parts of the UI, only change along with the window size
+    def __generate_UI_surfaces(self) -> None:
+        self.__progressBarsRect: pygame.Rect = pygame.Rect(0, self.__trailSurfaceSize[1], self.__windowSize[0], self.__mainProgressBarHeight + self.__subProgressBarHeight)
+        self.__toolbarRect: pygame.Rect = pygame.Rect(0, self.__progressBarsRect.bottom, self.__windowSize[0], self.__toolbarHeight)
+        progressBarSize: tuple[int, int] = (self.__windowSize[0], max(self.__mainProgressBarHeight, self.__subProgressBarHeight))
+        self.__progressBarFgSurface: pygame.Surface = pygame.Surface(progressBarSize)
+        self.__progressBarFgSurface.fill(self.__progressBarFg)
+        self.__progressBarBgSurface: pygame.Surface = pygame.Surface(progressBarSize)
+        self.__progressBarBgSurface.fill(self.__progressBarBg)
+
+        self.__toolbarBgSurface: pygame.Surface = pygame.Surface((self.__windowSize[0], self.__toolbarHeight), flags=pygame.SRCALPHA)
+        coordX: int = 0
+        for btn in self.__toolbarButtons:
+            pygame.draw.rect(self.__toolbarBgSurface, self.__toolbarBg, pygame.Rect(coordX, 0, btn['width'], self.__toolbarHeight))
+            coordX += btn['width'] + btn['rightMargin']
+
+    # Font rendering is slow, reuse surfaces of recently rendered text
+    def __render_text(self, text: str, color: tuple[int, int, int]) -> pygame.Surface:
+        key: tuple[str, tuple[int, int, int]] = (text, color)
+        textSurface: pygame.Surface | None = self.__textSurfaceCache.pop(key, None)
+        if textSurface is None:
+            if len(self.__textSurfaceCache) >= self.__textSurfaceCacheSize:
+                del self.__textSurfaceCache[next(iter(self.__textSurfaceCache))]  # Evict least recently used
+            textSurface = self.__font.render(text, True, color)
+        self.__textSurfaceCache[key] = textSurface  # Move to most recently used
+        return textSurface
+
     def handle_click(self, coords: tuple[int, int]) -> tuple[str, Any] | None:
         for boundingBox in self.__progressBarBoundingBoxes:
             if boundingBox['rect'].collidepoint(*coords):
                 return boundingBox['callback']((coords[0] - boundingBox['rect'].left, coords[1] - boundingBox['rect'].top))
-        for boundingBox in self.__toolbarBtnBoundingBoxes:
-            if boundingBox['rect'].collidepoint(*coords):
-                return boundingBox['btn']['callback'](boundingBox['btn'])
+        if self.__toolbarRect.collidepoint(*coords):
+            # Buttons are laid out left to right, find the first one ending after the click
+            btnIndex: int = bisect_right(self.__toolbarBtnEndsX, coords[0])
+            if btnIndex < len(self.__toolbarButtons) and coords[0] >= self.__toolbarBtnStartsX[btnIndex]:
+                btn: dict[str, Any] = self.__toolbarButtons[btnIndex]
+                return btn['callback'](btn)
         return None
 
     def __generate_toolbar_bounding_boxes(self, toolbarCoords: tuple[int, int]) -> None:
-        coordX, coordY = toolbarCoords
-        self.__toolbarBtnBoundingBoxes.clear()
+        coordX: int = toolbarCoords[0]
+        self.__toolbarBtnStartsX.clear()
+        self.__toolbarBtnEndsX.clear()  # Exclusive
         for btn in self.__toolbarButtons:
-            self.__toolbarBtnBoundingBoxes.append({'btn': btn,
-                                                   'rect': pygame.Rect(coordX, coordY, btn['width'], self.__toolbarHeight)})
+            self.__toolbarBtnStartsX.append(coordX)
+            self.__toolbarBtnEndsX.append(coordX + btn['width'])
             coordX += btn['width'] + btn['rightMargin']
 
     def __generate_progress_bar_bounding_boxes(self, progressBarCoords: tuple[int, int]) -> None:
         progressBarWidth: int = self.__windowSize[0]
         coordX, coordY = progressBarCoords
-        self.__progressBarBoundingBoxes.clear()
+        if not self.__progressBarBoundingBoxes:
+            self.__progressBarBoundingBoxes.append({'callback': self.__main_progress_bar_callback, 'rect': pygame.Rect(0, 0, 0, 0)})
+            self.__progressBarBoundingBoxes.append({'callback': self.__sub_progress_bar_callback, 'rect': pygame.Rect(0, 0, 0, 0)})
 
-        self.__progressBarBoundingBoxes.append({'callback': self.__main_progress_bar_callback,
-                                                'rect': pygame.Rect(coordX, coordY, progressBarWidth, self.__mainProgressBarHeight)})
+        # Update in place, no need for new objects on every window size change
+        self.__progressBarBoundingBoxes[0]['rect'].update(coordX, coordY, progressBarWidth, self.__mainProgressBarHeight)
         coordY += self.__mainProgressBarHeight
 
-        self.__progressBarBoundingBoxes.append({'callback': self.__sub_progress_bar_callback,
-                                                'rect': pygame.Rect(coordX, coordY, progressBarWidth, self.__subProgressBarHeight)})
+        self.__progressBarBoundingBoxes[1]['rect'].update(coordX, coordY, progressBarWidth, self.__subProgressBarHeight)
 
     def window_size_changed(self) -> None:
+        self.__generate_UI_surfaces()
+        self.__windowDirty = True
         self.__generate_progress_bar_bounding_boxes((0, self.__trailSurfaceSize[1]))
         self.__generate_toolbar_bounding_boxes((0, self.__trailSurfaceSize[1] + self.__mainProgressBarHeight + self.__subProgressBarHeight))
 
@@ -298,17 +450,34 @@ class View_UI:
         return self.__trailSurface.get_size()
 
     def fill_window(self, color: tuple[int, int, int] | None = None) -> None:
+        if color is not None:
+            self.__windowDirty = True
         self.__windowSurface.fill(color if color is not None else self.__trailBg)
 
+    # Next pop_dirty_rects returns the whole window, e.g. when the OS lost the window contents
+    def invalidate_window(self) -> None:
+        self.__windowDirty = True
+
+    # For pygame.display.update(), resets on call
+    def pop_dirty_rects(self) -> list[pygame.Rect]:
+        dirtyRects: list[pygame.Rect] = self.__displayDirtyRects
+        self.__displayDirtyRects = []
+        if self.__windowDirty:
+            self.__windowDirty = False
+            return [self.__windowSurface.get_rect()]
+        # Last frame's and this frame's trails mostly overlap, so do the progress bars and toolbar
+        return self.__merge_rects(dirtyRects, self.__windowSurface.get_rect())
+
 
 class Controller:
     TAG: str = 'Controller'
 
-    __file: TextIOWrapper | None = None
+    __file: BufferedReader | None = None
+    __fileLineBuffer: deque[bytes] = deque()  # Lines read ahead, replaced in load_file
     __fileInitialPosition: int = 0
     __fileTotalLines: int = 0
+    __fileLineOffsets: array = array('q')  # Byte offset of each line, plus EOF
     __fileNextLineNum: int = 0  # Index starts with 0
-    __previousSlots: dict[int, dict[str, int | None]] = {}
     __previousSynEventTmstmp: int | None = None
     __waitingStartTmstmp: int = 0
     __waitingTargetTmstmp: int | None = None
@@ -318,52 +487,68 @@ class Controller:
     __currentEventLine: str = ''
     __paused: bool = False
     __eventProcessingQuotaMs: int = 8  # TODO
+    __msPerDay: int = 86400000
 
     def __init__(self, eventParser: Model_EventParser, viewUI: View_UI, eventXResolution: int, eventYResolution: int) -> None:
         self.__eventParser: Model_EventParser = eventParser
         self.__viewUI: View_UI = viewUI
         self.__eventXRes: int = eventXResolution
         self.__eventYRes: int = eventYResolution
+        # Trail surface never changes size, no need to look it up for every coordinate
+        surfaceW, surfaceH = self.__viewUI.get_trail_surface_size()
+        self.__scaleXNumerator: int = surfaceW - 1
+        self.__scaleXDenominator: int = eventXResolution - 1
+        self.__scaleYNumerator: int = surfaceH - 1
+        self.__scaleYDenominator: int = eventYResolution - 1
         self.__clock = pygame.time.Clock()
+        self.__previousSlots: tuple[array, array, array] = (array('q'), array('q'), array('q'))
+        self.__warnedBogusSlots: set[tuple[int, int]] = set()  # (slot ID, tracking ID)
 
     def __scale_coords(self, x: int, y: int) -> tuple[int, int]:
-        surfaceW, surfaceH = self.__viewUI.get_trail_surface_size()
-        return (x * (surfaceW - 1) // (self.__eventXRes - 1),
-                y * (surfaceH - 1) // (self.__eventYRes - 1))
+        return (x * self.__scaleXNumerator // self.__scaleXDenominator,
+                y * self.__scaleYNumerator // self.__scaleYDenominator)
 
-    def __safe_get_slot(self, slots: dict[int, dict[str, int | None]], slotID: int) -> dict[str, int] | None:
-        if slotID not in slots.keys():
+    # Returns (tracking ID, x, y)
+    def __safe_get_slot(self, slots: tuple[array, array, array], slotID: int) -> tuple[int, int, int] | None:
+        trackingIDs, xs, ys = slots
+        if slotID >= len(trackingIDs):
             return None
-        if slots[slotID]['tracking_id'] is None:
+        if trackingIDs[slotID] == -1:
             return None
-        for key, value in slots[slotID].items():
-            if value is None:
-                if key != 'tracking_id':
-                    print('{}: Warning: Bogus event: None coordinate(s) under non-None tracking ID'.format(self.TAG))
-                return None
-        return slots[slotID]  # type: ignore
+        if xs[slotID] == -1 or ys[slotID] == -1:
+            # Checked on every SYN_REPORT, only warn once for each touch
+            if (slotID, trackingIDs[slotID]) not in self.__warnedBogusSlots:
+                self.__warnedBogusSlots.add((slotID, trackingIDs[slotID]))
+                logger.warning('{}: Bogus event: None coordinate(s) under non-None tracking ID {} in slot {}'.format(self.TAG, trackingIDs[slotID], slotID))
+            return None
+        return trackingIDs[slotID], xs[slotID], ys[slotID]
 
-    def __draw_slots(self, slots: dict[int, dict[str, int | None]], previousSlots: dict[int, dict[str, int | None]], currentTimestampMs: int) -> None:
-        assert(len(previousSlots) <= len(slots))  # Slots don't shrink, they only grow when required.
-        for slotID in slots.keys():
-            slot: dict[str, int] | None = self.__safe_get_slot(slots, slotID)
-            previousSlot: dict[str, int] | None = self.__safe_get_slot(previousSlots, slotID)
+    def __draw_slots(self, slots: tuple[array, array, array], previousSlots: tuple[array, array, array], currentTimestampMs: int) -> None:
+        assert(len(previousSlots[0]) <= len(slots[0]))  # Slots don't shrink, they only grow when required.
+        for slotID in range(len(slots[0])):
+            slot: tuple[int, int, int] | None = self.__safe_get_slot(slots, slotID)
+            previousSlot: tuple[int, int, int] | None = self.__safe_get_slot(previousSlots, slotID)
             if slot is None:
                 if previousSlot is not None:
                     self.__viewUI.fade_persistent_trail(slotID, currentTimestampMs)
             else:
                 if previousSlot is not None:
-                    if previousSlot['tracking_id'] == slot['tracking_id']:
-                        self.__viewUI.add_trail(self.__scale_coords(previousSlot['x'], previousSlot['y']), \
-                                               self.__scale_coords(slot['x'], slot['y']), \
+                    if previousSlot[0] == slot[0]:
+                        self.__viewUI.add_trail(self.__scale_coords(previousSlot[1], previousSlot[2]), \
+                                               self.__scale_coords(slot[1], slot[2]), \
                                                currentTimestampMs)
                     else:
                         self.__viewUI.fade_persistent_trail(slotID, currentTimestampMs)
-                self.__viewUI.add_persistent_trail(None, self.__scale_coords(slot['x'], slot['y']), slotID)
+                self.__viewUI.add_persistent_trail(None, self.__scale_coords(slot[1], slot[2]), slotID)
 
-    def __realtime_event_tick(self) -> tuple[float, str] | None:
+    def __draw_slots_and_snapshot(self, currentTimestampMs: int) -> None:
+        slots: tuple[array, array, array] = self.__eventParser.get_slots()
+        self.__draw_slots(slots, self.__previousSlots, currentTimestampMs)
+        for previousColumn, column in zip(self.__previousSlots, slots):
+            previousColumn[:] = column  # Copy in place, no allocation once sizes settle
+
+    def __realtime_event_tick(self, currentMs: int) -> tuple[float, str] | None:
         assert(self.__file is not None)
-        currentMs: int = pygame.time.get_ticks()
         waitingTimeOffset: int = 0
 
         if self.__skipWaitingFlag:
@@ -380,9 +565,7 @@ class Controller:
                 waitingTimeOffset = self.__waitingTargetTmstmp - currentMs
                 self.__waitingTargetTmstmp = None
 
-                slots: dict[int, dict[str, int | None]] = self.__eventParser.get_slots()
-                self.__draw_slots(slots, self.__previousSlots, currentMs)
-                self.__previousSlots = copy.deepcopy(slots)
+                self.__draw_slots_and_snapshot(currentMs)
 
         if self.__skipWaitingTimeOffsetFlag:
             waitingTimeOffset = 0
@@ -399,15 +582,20 @@ class Controller:
         if synEventTimestamp is not None:
             if self.__previousSynEventTmstmp is not None:
                 self.__waitingStartTmstmp = currentMs
-                self.__waitingTargetTmstmp = round((synEventTimestamp - self.__previousSynEventTmstmp) / self.__waitingTimeDivisor) + currentMs + waitingTimeOffset
+                self.__waitingTargetTmstmp = round(self.__timestamp_delta(self.__previousSynEventTmstmp, synEventTimestamp) / self.__waitingTimeDivisor) + currentMs + waitingTimeOffset
             else:  # Usually executed only once
-                slots: dict[int, dict[str, int | None]] = self.__eventParser.get_slots()
-                self.__draw_slots(slots, self.__previousSlots, currentMs)
-                self.__previousSlots = copy.deepcopy(slots)
+                self.__draw_slots_and_snapshot(currentMs)
             
             self.__previousSynEventTmstmp = synEventTimestamp        
         return (1, self.__currentEventLine)
 
+    # Event timestamps are milliseconds since midnight, so a huge negative delta means the log crossed midnight
+    def __timestamp_delta(self, previousTimestamp: int, timestamp: int) -> int:
+        delta: int = timestamp - previousTimestamp
+        if delta < -self.__msPerDay // 2:
+            delta += self.__msPerDay
+        return delta
+
     # Effect includes __skip_waiting_time_offset
     def __skip_waiting(self) -> None:
         self.__skipWaitingFlag = True
@@ -419,7 +607,7 @@ class Controller:
         self.__viewUI.fill_window()
         self.__viewUI.update_trails(currentTimestampMs)
         self.__viewUI.draw_UI(mainProgressBarPercentage, mainProgressBarText, subProgressBarPercentage)
-        pygame.display.update()
+        pygame.display.update(self.__viewUI.pop_dirty_rects())
 
     def main_loop(self) -> None:  # Timing is difficult, as is my life.
         lastFrameEndTmstmpMs: int = pygame.time.get_ticks()
@@ -437,8 +625,16 @@ class Controller:
                 if lastNopTimeMs > 0:
                     self.__eventProcessingQuotaMs = lastNopTimeMs
                 if timeBuffer > 0:
-                    while pygame.time.get_ticks() < frameStartTmstmpMs + self.__eventProcessingQuotaMs:
-                        ret = self.__realtime_event_tick()
+                    eventProcessingDeadlineMs: int = frameStartTmstmpMs + self.__eventProcessingQuotaMs
+                    currentMs: int = frameStartTmstmpMs
+                    eventTickCount: int = 0
+                    while True:
+                        if eventTickCount & 15 == 0:  # A single tick is way shorter than 1 ms, no need to ask SDL every time
+                            currentMs = pygame.time.get_ticks()
+                            if currentMs >= eventProcessingDeadlineMs:
+                                break
+                        eventTickCount += 1
+                        ret = self.__realtime_event_tick(currentMs)
                         if ret is None:
                             eofReached = True
                             break
@@ -456,6 +652,8 @@ class Controller:
                 if event.type == pygame.QUIT:
                     pygame.quit()
                     sys.exit()
+                if event.type in (pygame.WINDOWEXPOSED, pygame.VIDEOEXPOSE, pygame.WINDOWRESTORED, pygame.WINDOWSHOWN):
+                    self.__viewUI.invalidate_window()  # Only dirty rects are pushed otherwise, leaving the rest blank
                 if event.type == pygame.MOUSEBUTTONDOWN:
                     clickEvent: tuple[str, Any] | None = self.__viewUI.handle_click(event.pos)
                     if clickEvent is not None:
@@ -478,36 +676,39 @@ class Controller:
                                 self.__viewUI.fade_persistent_trail(None, finishEventProcessingTmstmpMs)
                                 self.__skip_waiting()
                             case _:
-                                print('{}: Warning: Unhandled clickEvent {}, value {}'.format(self.TAG, *clickEvent))
+                                logger.warning('{}: Unhandled clickEvent {}, value {}'.format(self.TAG, *clickEvent))
             assert(waitingPercentage is not None)
             self.__update_display(finishEventProcessingTmstmpMs, self.__fileNextLineNum / self.__fileTotalLines, lastEventLine.strip(), waitingPercentage)
 
             lastFrameEndTmstmpMs = pygame.time.get_ticks()
             self.__clock.tick(120)
 
-    def load_file(self, file: TextIOWrapper) -> None:  # TODO
+    # Expects a binary file, preferably with a large buffer, e.g. open(path, 'rb', buffering=1 << 20)
+    def load_file(self, file: BufferedReader) -> None:  # TODO
         self.__file = file
         self.__fileInitialPosition = file.tell()
-        self.__fileTotalLines = self.__file_get_total_lines()
+        self.__file_index_lines()
         self.__fileNextLineNum = 0
+        self.__fileLineBuffer = deque()
 
-    def __file_get_total_lines(self) -> int:
+    # Builds the byte offset of every line in one pass, so that seeking to any line is a single seek()
+    def __file_index_lines(self) -> None:
         assert(self.__file is not None)
-        totalLines: int = 0
-        while True:
-            if not self.__file.readline():
-                break
-            totalLines += 1
+        # Line lengths are summed up in C, a last line without trailing newline simply ends at EOF
+        lineOffsets: array = array('q', accumulate(map(len, self.__file), initial=self.__fileInitialPosition))
+        self.__fileLineOffsets = lineOffsets  # Last one is EOF
+        self.__fileTotalLines = len(lineOffsets) - 1
         self.__file.seek(self.__fileInitialPosition, SEEK_SET)
-        return totalLines
 
+    # Lines are read ahead in batches of about 1 MiB, way cheaper than a readline() for each
     def __file_read_line(self) -> str | None:
         assert(self.__file is not None)
-        line: str = self.__file.readline()
-        if line:
-            self.__fileNextLineNum += 1
-            return line
-        return None
+        if not self.__fileLineBuffer:
+            self.__fileLineBuffer.extend(self.__file.readlines(1 << 20))
+            if not self.__fileLineBuffer:
+                return None
+        self.__fileNextLineNum += 1
+        return self.__fileLineBuffer.popleft().decode('ascii')
 
     # Next __file_read_line would return the line specified; index of first line is 0
     def __file_goto_line(self, lineIndex: int) -> None:
@@ -516,14 +717,9 @@ class Controller:
         lineIndex = min(lineIndex, self.__fileTotalLines)  # Max is EOF
         if lineIndex == self.__fileNextLineNum:
             return
-        elif lineIndex > self.__fileNextLineNum:
-            for _ in range(lineIndex - self.__fileNextLineNum):
-                self.__file_read_line()
-        else:
-            self.__file.seek(self.__fileInitialPosition, SEEK_SET)
-            self.__fileNextLineNum = 0
-            for _ in range(lineIndex):
-                self.__file_read_line()
+        self.__file.seek(self.__fileLineOffsets[lineIndex], SEEK_SET)
+        self.__fileLineBuffer.clear()
+        self.__fileNextLineNum = lineIndex
 
 
 if __name__ == '__main__':
@@ -531,6 +727,6 @@ if __name__ == '__main__':
     viewUI = View_UI(450, 1080, 'ActionReplay', 40, 10, 30, 1000)
     controller = Controller(eventParser, viewUI, 1080 * 16, 2400 * 16)
 
-    with open('Your_Events_Here.txt', 'r') as f:
+    with open('Your_Events_Here.txt', 'rb', buffering=1 << 20) as f:
         controller.load_file(f)
         controller.main_loop()